@@ -1 +1,5 @@
-from .complexity import molecular_complexity
+from .complexity import (
+    molecular_complexity,
+    molecular_complexity_batch,
+    molecular_complexity_many,
+)
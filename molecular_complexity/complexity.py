@@ -1,17 +1,35 @@
 """
 This is the code to calculate the CM, CM_star and Cse metrics.
 """
-from collections import Counter
-from typing import Dict, Iterator, List, NamedTuple, Tuple
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import numpy as np
 from rdkit import Chem
 
+try:
+    import numexpr as ne
+except ImportError:  # numexpr is optional, fall back to plain NumPy
+    ne = None
+
 # Atom types are defined as (symbol, total degree, non-h degree)
 AtomType = Tuple[str, int, int]
-# Atoms are defined as (atom index, atom type)
-Atom = Tuple[int, AtomType]
-AtomDict = Dict[Atom, List[Atom]]
+
+# Bits per atom type id in a packed atom path
+_TYPE_BITS = np.uint64(21)
+
+# Smallest array for which the entropy terms are evaluated with numexpr, below
+# this its per-call overhead outweighs the fused loop
+_NUMEXPR_MIN_SIZE = 100_000
+
+# Atom type of a hydrogen bonded to a heavy atom
+_H_TYPE: AtomType = ("H", 1, 1)
+
+# Process-wide pool of small integer ids for the atom types seen so far
+_ATOM_TYPE_IDS: Dict[AtomType, int] = {}
+_ATOM_TYPE_IDS_LOCK = threading.Lock()
 
 
 class MolecularComplexity(NamedTuple):
@@ -20,36 +38,115 @@ class MolecularComplexity(NamedTuple):
     cse: float
 
 
-def _non_h_items(data: Dict[Atom, any]) -> Iterator[Tuple[Atom, any]]:
+def _neighbor_arrays(mols: List[Chem.rdchem.Mol]) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Generator for non-H items from a dictionary where the keys are atom tuples.
-    """
-    for key, val in data.items():
-        if key[1][0] != "H":
-            yield key, val
-
+    Returns the neighbors of every atom in compressed sparse row form.
 
-def _collect_atom_paths(neighbors: AtomDict) -> List[List[tuple]]:
+    Atoms are numbered consecutively across the molecules, and the neighbors
+    of atom i are idx[ptr[i]:ptr[i + 1]]. The bonds are read in a single pass
+    over the molecules, and sorted into neighbor lists with NumPy.
     """
-    Returns list of atom paths for each atom.
-
-    An atom path is a tuple of atom types.
+    bonds = [np.zeros((0, 2), dtype=np.int32)]
+    n_atoms = 0
+    for mol in mols:
+        mol_bonds = np.array(
+            [(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()) for bond in mol.GetBonds()],
+            dtype=np.int32,
+        )
+        bonds.append(mol_bonds.reshape(-1, 2) + n_atoms)
+        n_atoms += mol.GetNumAtoms()
+    bonds = np.concatenate(bonds)
+
+    # each bond makes its atoms neighbors of one another
+    atoms = np.concatenate([bonds[:, 0], bonds[:, 1]])
+    neighbors = np.concatenate([bonds[:, 1], bonds[:, 0]])
+    order = np.lexsort((neighbors, atoms))
+
+    ptr = np.zeros(n_atoms + 1, dtype=np.int32)
+    ptr[1:] = np.cumsum(np.bincount(atoms, minlength=n_atoms))
+    return ptr, neighbors[order]
+
+
+def _collect_atom_paths(
+    ptr: np.ndarray,
+    idx: np.ndarray,
+    type_ids: np.ndarray,
+    is_h: np.ndarray,
+    n_hs: np.ndarray,
+    h_type_id: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    atom_paths = []
-    for atom, nbs in _non_h_items(neighbors):
-        paths = []
-        for nb in nbs:
-            if nb[1][0] == "H" or neighbors[nb] == [atom]:
-                # No second neighbors
-                paths.append((atom[1], nb[1]))
-            else:
-                paths.extend(
-                    (atom[1], nb[1], nb2[1]) for nb2 in neighbors[nb] if nb2 != atom
-                )
+    Returns the atom paths of all non-H atoms.
+
+    An atom path is the atom type ids of (atom, neighbor, second neighbor)
+    packed into one np.uint64, with 21 bits per id. Ids are offset by one, so
+    paths without a second neighbor have zero in the lowest bits.
 
-        atom_paths.append(paths)
+    Hydrogens that are not atoms of the graph are given by their number n_hs
+    on each atom, and enter the paths with the type id h_type_id. The paths to
+    the hydrogens of an atom are identical, so each is emitted once together
+    with its multiplicity rather than repeated.
 
-    return atom_paths
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): the non-H atom each path emanates
+        from, numbered over non-H atoms only, the atom paths, and the number of
+        times each path occurs
+    """
+    degree = np.diff(ptr)
+    total_degree = degree + n_hs
+    atoms = np.repeat(np.arange(len(degree)), degree)
+    heavy = ~is_h[atoms]
+    atoms, nbs = atoms[heavy], idx[heavy]
+
+    # No second neighbors for H neighbors or neighbors bonded only to the atom
+    end = is_h[nbs] | (total_degree[nbs] == 1)
+    short_atoms, short_nbs = atoms[end], nbs[end]
+    atoms_with_hs = np.flatnonzero(~is_h & (n_hs > 0))
+
+    # Expand the remaining neighbors over their own neighbors
+    atoms, nbs = atoms[~end], nbs[~end]
+    n_nb2 = degree[nbs]
+    offsets = np.repeat(ptr[nbs] - (np.cumsum(n_nb2) - n_nb2), n_nb2)
+    nb2s = idx[offsets + np.arange(n_nb2.sum())]
+    nb2_atoms = np.repeat(atoms, n_nb2)
+    # Skip the path back to the atom itself, comparing atom indices
+    keep = nb2s != nb2_atoms
+    long_atoms = nb2_atoms[keep]
+    long_nbs = np.repeat(nbs, n_nb2)[keep]
+    nb2s = nb2s[keep]
+    # and over their hydrogens
+    has_hs = n_hs[nbs] > 0
+    nb_h_atoms, nb_h_nbs = atoms[has_hs], nbs[has_hs]
+
+    ids = type_ids.astype(np.uint64) + np.uint64(1)
+    h_id = np.uint64(h_type_id + 1)
+    path_atoms = np.concatenate([short_atoms, atoms_with_hs, long_atoms, nb_h_atoms])
+    nb_ids = np.concatenate(
+        [
+            ids[short_nbs],
+            np.full(len(atoms_with_hs), h_id),
+            ids[long_nbs],
+            ids[nb_h_nbs],
+        ]
+    )
+    nb2_ids = np.concatenate(
+        [
+            np.zeros(len(short_atoms) + len(atoms_with_hs), dtype=np.uint64),
+            ids[nb2s],
+            np.full(len(nb_h_atoms), h_id),
+        ]
+    )
+    paths = (((ids[path_atoms] << _TYPE_BITS) | nb_ids) << _TYPE_BITS) | nb2_ids
+    multiplicities = np.concatenate(
+        [
+            np.ones(len(short_atoms), dtype=np.int64),
+            n_hs[atoms_with_hs],
+            np.ones(len(long_atoms), dtype=np.int64),
+            n_hs[nb_h_nbs],
+        ]
+    )
+    heavy_ids = np.cumsum(~is_h) - 1
+    return heavy_ids[path_atoms], paths, multiplicities
 
 
 def get_atom_type(atom: Chem.rdchem.Mol) -> AtomType:
@@ -65,28 +162,198 @@ def get_atom_type(atom: Chem.rdchem.Mol) -> AtomType:
     return (symbol, degree, non_h)
 
 
+def _atom_type_id(atom_type: AtomType) -> int:
+    """
+    Return the id of the atom type in the process-wide atom type pool.
+
+    Equal atom types share one id across all molecules, and new atom types
+    are added to the pool on first use.
+    """
+    type_id = _ATOM_TYPE_IDS.get(atom_type)
+    if type_id is None:
+        with _ATOM_TYPE_IDS_LOCK:
+            type_id = _ATOM_TYPE_IDS.setdefault(atom_type, len(_ATOM_TYPE_IDS))
+    return type_id
+
+
 def fractional_occurrence(data: list) -> np.ndarray:
     """
     Calculate the fractional occurrence of unique items in the input data.
 
-    Uniqueness determined by collections.Counter.
+    Each unique item is mapped to an integer id in order of first appearance,
+    and the ids are counted with np.bincount.
 
     Returns:
         np.ndarray: fractional occurrence of unique items
     """
-    counter = Counter(data)
-    counts = np.array(list(counter.values()))
+    item_ids = {}
+    ids = np.fromiter(
+        (item_ids.setdefault(item, len(item_ids)) for item in data),
+        dtype=np.int64,
+        count=len(data),
+    )
+    counts = np.bincount(ids)
     return counts / len(data)
 
 
+def _entropy_terms(p: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Return the Shannon entropy terms -p*log2(p) of an array of probabilities.
+
+    Uses numexpr when available to evaluate the expression without temporaries,
+    but only for large arrays, e.g. of a batch of molecules. The few terms of a
+    single molecule are cheaper to evaluate with plain NumPy ufuncs.
+    The terms are written to out if given, which may be p itself.
+    """
+    if ne is not None and p.size >= _NUMEXPR_MIN_SIZE:
+        return ne.evaluate(
+            "-p * log(p) / ln2", local_dict={"p": p, "ln2": np.log(2)}, out=out
+        )
+    log_p = np.log2(p)
+    return np.negative(np.multiply(p, log_p, out=out), out=out)
+
+
+def _count_pairs(
+    groups: np.ndarray,
+    items: np.ndarray,
+    n_items: int,
+    weights: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count the occurrence of each (group, item) pair of integer ids.
+
+    If weights are given, each input pair counts as that many occurrences.
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): group, item and count of each
+        distinct pair, sorted by group and then by item
+    """
+    n_items = max(n_items, 1)
+    keys = groups * n_items + items
+    if weights is None:
+        pairs, counts = np.unique(keys, return_counts=True)
+    else:
+        pairs, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, weights=weights).astype(np.int64)
+    return pairs // n_items, pairs % n_items, counts
+
+
+def _group_entropies(
+    groups: np.ndarray, counts: np.ndarray, n_groups: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculate the Shannon entropy of the item occurrences within each group.
+
+    Takes the count of each distinct (group, item) pair, so that the entropy
+    terms of all groups can be summed in a single np.bincount.
+
+    Returns:
+        (np.ndarray, np.ndarray): entropy and total count of each group
+    """
+    totals = np.bincount(groups, weights=counts, minlength=n_groups)
+    group_totals = totals[groups]
+
+    # Groups with a single item, e.g. the atoms of a symmetric ring, have zero
+    # entropy, so only the pairs of groups with several items need a logarithm
+    mixed = counts < group_totals
+    p = counts[mixed] / group_totals[mixed]
+    entropies = np.bincount(
+        groups[mixed], weights=_entropy_terms(p, out=p), minlength=n_groups
+    )
+    return entropies, totals
+
+
+def _batch_complexity(mols: List[Chem.rdchem.Mol]) -> np.ndarray:
+    """
+    Calculate CM, CM* and Cse of several molecules in one vectorized pass.
+
+    Atom types, path types and atom environments are numbered once across all
+    the molecules, so every reduction runs over the whole batch at once.
+
+    Returns:
+        np.ndarray: array of shape (len(mols), 3) with CM, CM* and Cse
+    """
+    # get atom type ids and hydrogen counts for each atom in the molecules
+    atoms = [atom for mol in mols for atom in mol.GetAtoms()]
+    type_ids = np.array(
+        [_atom_type_id(get_atom_type(atom)) for atom in atoms], dtype=np.int32
+    )
+    n_hs = np.array([atom.GetTotalNumHs() for atom in atoms], dtype=np.int32)
+    h_type_id = _atom_type_id(_H_TYPE)
+    with _ATOM_TYPE_IDS_LOCK:
+        h_types = np.array([t[0] == "H" for t in _ATOM_TYPE_IDS], dtype=bool)
+    is_h = h_types[type_ids]
+
+    # the molecule of each non-H atom
+    n_mols = len(mols)
+    mol_sizes = [mol.GetNumAtoms() for mol in mols]
+    atom_mols = np.repeat(np.arange(n_mols), mol_sizes)[~is_h]
+    n_atoms = len(atom_mols)
+
+    ptr, idx = _neighbor_arrays(mols)
+    path_atoms, paths, multiplicities = _collect_atom_paths(
+        ptr, idx, type_ids, is_h, n_hs, h_type_id
+    )
+
+    # count the occurrence of each path type emanating from each atom
+    path_types, path_ids = np.unique(paths, return_inverse=True)
+    pair_atoms, pair_paths, pair_counts = _count_pairs(
+        path_atoms, path_ids, len(path_types), weights=multiplicities
+    )
+
+    entropies, total_paths = _group_entropies(pair_atoms, pair_counts, n_atoms)
+    # atoms without paths, e.g. ions, have CA = log2(0) = -inf
+    with np.errstate(divide="ignore"):
+        cas = np.log2(total_paths)
+    cas += entropies
+
+    cm = np.bincount(atom_mols, weights=cas, minlength=n_mols)
+
+    # CM* is a log-sum-exp, shifted by the largest CA of each molecule so that
+    # the exponentials cannot overflow
+    max_cas = np.full(n_mols, -np.inf)
+    np.maximum.at(max_cas, atom_mols, cas)
+    shift = np.where(np.isfinite(max_cas), max_cas, 0.0)
+    exp_cas = cas - shift[atom_mols]
+    np.exp2(exp_cas, out=exp_cas)
+    with np.errstate(divide="ignore"):
+        cm_star = shift + np.log2(
+            np.bincount(atom_mols, weights=exp_cas, minlength=n_mols)
+        )
+
+    # the sorted path types and their counts describe the atom environments,
+    # so the raw bytes of each atom's rows serve as its environment key
+    environments = np.column_stack([pair_paths, pair_counts])
+    starts = np.searchsorted(pair_atoms, np.arange(n_atoms + 1))
+    environment_ids = {}
+    atom_environments = np.array(
+        [
+            environment_ids.setdefault(
+                environments[a:b].tobytes(), len(environment_ids)
+            )
+            for a, b in zip(starts[:-1], starts[1:])
+        ],
+        dtype=np.int64,
+    )
+
+    # Now we can calculate the Cse metric as the fractional occurrence of each atom environment
+    pair_mols, _, environment_counts = _count_pairs(
+        atom_mols, atom_environments, len(environment_ids)
+    )
+    cse, _ = _group_entropies(pair_mols, environment_counts, n_mols)
+
+    return np.column_stack([cm, cm_star, cse])
+
+
 def calculate_molecular_complexity(mol: Chem.rdchem.Mol) -> MolecularComplexity:
     """
     This is a function to calculate the molecular complexity metrics described in
     Proudfoot, Bioorganic & Medicinal Chemistry Letters 27 (2017) 2014-2017.
     https://doi.org/10.1016/j.bmcl.2017.03.008
 
-    This function takes an RDKit Mol object, enumerates atom paths,
-    and then calculates the complexity environment for each atom CA as
+    This function takes an RDKit Mol object, with hydrogens either implicit
+    or as explicit atoms, enumerates atom paths, and then calculates the
+    complexity environment for each atom CA as
 
     CA = - Sum (pi*log2(pi)) + log2(N)
 
@@ -103,46 +370,95 @@ def calculate_molecular_complexity(mol: Chem.rdchem.Mol) -> MolecularComplexity:
     Cse = - Sum (qi*log2(qi))
 
     where qi is the fractional occurrence of an atom environment.
+
+    An atom without any paths, e.g. an ion, has CA = log2(0) = -inf, which
+    makes CM -inf. CM* is -inf only if no atom has a finite CA, e.g. for
+    [Na+].[Cl-], or for [H][H] which has no non-H atoms.
     """
-    # get atom types for each atom in the molecule
-    atoms = [(atom.GetIdx(), get_atom_type(atom)) for atom in mol.GetAtoms()]
+    cm, cm_star, cse = _batch_complexity([mol])[0]
 
-    # create dict with neighbors of each atom
-    neighbors = {
-        atom: [
-            atoms[neighbor.GetIdx()]
-            for neighbor in mol.GetAtomWithIdx(atom[0]).GetNeighbors()
-        ]
-        for atom in atoms
-    }
+    return MolecularComplexity(cm, cm_star, cse)
 
-    atom_paths = _collect_atom_paths(neighbors)
 
-    cas = np.zeros(len(atom_paths))
-    for i, paths in enumerate(atom_paths):
-        total_paths = len(paths)
-        pi = fractional_occurrence(paths)
-        cas[i] = -np.sum(pi * np.log2(pi)) + np.log2(total_paths)
+@functools.lru_cache(maxsize=4096)
+def _prepare_mol(smiles: str) -> Optional[Chem.rdchem.Mol]:
+    """
+    Memoized parsing of SMILES for repeated test and profiling runs.
 
-    cm = np.sum(cas)
+    The returned Mol is shared between callers and must not be modified.
+    """
+    return _parse_smiles(smiles)
 
-    cm_star = np.log2(np.sum(2**cas))
 
-    # sort and concatenate the individual paths to compare the atom environments
-    atom_environments = [tuple(sorted(paths)) for paths in atom_paths]
+def _parse_smiles(smiles: str) -> Optional[Chem.rdchem.Mol]:
+    """Parse SMILES, returning None if the SMILES is invalid"""
+    try:
+        return Chem.MolFromSmiles(smiles)
+    except Exception:
+        return None
 
-    # Now we can calculate the Cse metric as the fractional occurrence of each atom environment
-    qi = fractional_occurrence(atom_environments)
-    cse = -np.sum(qi * np.log2(qi))
 
-    return MolecularComplexity(cm, cm_star, cse)
+# Metrics of the molecules seen so far, keyed on canonical SMILES. The oldest
+# entry is dropped once the cache holds _COMPLEXITY_CACHE_SIZE molecules
+_COMPLEXITY_CACHE: Dict[str, MolecularComplexity] = {}
+_COMPLEXITY_CACHE_SIZE = 100_000
 
 
 def molecular_complexity(smiles: str) -> MolecularComplexity:
-    """This function takes SMILES and returns the CM, CM*, and Cse metrics"""
+    """
+    This function takes SMILES and returns the CM, CM*, and Cse metrics
+
+    Results are cached on the canonical SMILES, so equivalent SMILES of a
+    molecule that was already seen are not calculated again.
+    """
     try:
         mol = Chem.MolFromSmiles(smiles)
-        mol = Chem.AddHs(mol)
-        return calculate_molecular_complexity(mol)
+        canonical_smiles = Chem.MolToSmiles(mol)
+        result = _COMPLEXITY_CACHE.get(canonical_smiles)
+        if result is None:
+            result = calculate_molecular_complexity(mol)
+            if len(_COMPLEXITY_CACHE) >= _COMPLEXITY_CACHE_SIZE:
+                _COMPLEXITY_CACHE.pop(next(iter(_COMPLEXITY_CACHE)), None)
+            _COMPLEXITY_CACHE[canonical_smiles] = result
+        return result
     except Exception:
         return MolecularComplexity(np.nan, np.nan, np.nan)
+
+
+def molecular_complexity_batch(smiles_list: List[str]) -> np.ndarray:
+    """
+    This function takes a list of SMILES and returns the CM, CM*, and Cse metrics
+    of all molecules, calculated together in one vectorized pass.
+
+    Returns:
+        np.ndarray: array of shape (len(smiles_list), 3) with CM, CM* and Cse,
+        NaN for SMILES that cannot be parsed
+    """
+    mols = [_parse_smiles(smiles) for smiles in smiles_list]
+    valid = np.array([mol is not None for mol in mols], dtype=bool)
+    result = np.full((len(mols), 3), np.nan)
+    result[valid] = _batch_complexity([mol for mol in mols if mol is not None])
+    return result
+
+
+def molecular_complexity_many(
+    smiles_list: List[str], n_jobs: Optional[int] = None, chunksize: int = 1000
+) -> np.ndarray:
+    """
+    This function takes a list of SMILES and returns the CM, CM*, and Cse metrics
+    of all molecules, calculated in parallel worker processes.
+
+    The SMILES are split into chunks of chunksize, and each chunk is passed to
+    molecular_complexity_batch in one of n_jobs processes (by default one per CPU).
+
+    Returns:
+        np.ndarray: array of shape (len(smiles_list), 3) with CM, CM* and Cse,
+        NaN for SMILES that cannot be parsed
+    """
+    chunks = [
+        smiles_list[start : start + chunksize]
+        for start in range(0, len(smiles_list), chunksize)
+    ]
+    with ProcessPoolExecutor(n_jobs) as executor:
+        results = list(executor.map(molecular_complexity_batch, chunks))
+    return np.concatenate([np.empty((0, 3))] + results)
@@ -1,6 +1,17 @@
-import unittest
+import numpy as np
+import pytest
+from rdkit import Chem
 
-from .complexity import molecular_complexity
+from . import complexity
+from .complexity import (
+    _COMPLEXITY_CACHE,
+    _prepare_mol,
+    calculate_molecular_complexity,
+    fractional_occurrence,
+    molecular_complexity,
+    molecular_complexity_batch,
+    molecular_complexity_many,
+)
 
 TEST_CASES = [
     {
@@ -141,17 +152,95 @@ TEST_CASES = [
     },
 ]
 
+# Molecules with explicit hydrogen atoms, no heavy atoms, or atoms without paths
+HYDROGEN_TEST_CASES = [
+    {
+        "smiles": "[2H]CC",
+        "cm": 7.169925001442312,
+        "cm_star": 4.584962500721156,
+        "cse": -0.0,
+    },
+    {
+        "smiles": "[2H]C([2H])([2H])O",
+        "cm": 5.622556248918266,
+        "cm_star": 3.811278124459133,
+        "cse": 1.0,
+    },
+    {"smiles": "C", "cm": 2.0, "cm_star": 2.0, "cse": -0.0},
+    {"smiles": "[Na+].[Cl-]", "cm": -np.inf, "cm_star": -np.inf, "cse": -0.0},
+    {"smiles": "[H][H]", "cm": 0.0, "cm_star": -np.inf, "cse": -0.0},
+]
+
+
+@pytest.mark.parametrize(
+    "test_case",
+    TEST_CASES + HYDROGEN_TEST_CASES,
+    ids=[test_case["smiles"] for test_case in TEST_CASES + HYDROGEN_TEST_CASES],
+)
+def test_complexity_calculation(test_case):
+    """Test that we can calculate molecular complexity"""
+    cm, cm_star, cse = molecular_complexity(test_case["smiles"])
+    assert cm == pytest.approx(test_case["cm"], abs=1e-8)
+    assert cm_star == pytest.approx(test_case["cm_star"], abs=1e-8)
+    assert cse == pytest.approx(test_case["cse"], abs=1e-8)
+
+
+@pytest.mark.parametrize(
+    "smiles",
+    [test_case["smiles"] for test_case in TEST_CASES + HYDROGEN_TEST_CASES],
+)
+def test_explicit_hydrogens(smiles):
+    """Test that explicit hydrogen atoms give the same metrics as implicit ones"""
+    mol = _prepare_mol(smiles)
+    implicit = calculate_molecular_complexity(mol)
+    explicit = calculate_molecular_complexity(Chem.AddHs(mol))
+    assert explicit == pytest.approx(implicit, abs=1e-8)
+
+
+def test_fractional_occurrence():
+    """Test that unique items are counted in order of first appearance"""
+    data = [("C", 4, 1), ("O", 2, 1), ("C", 4, 1), ("N", 3, 1)]
+    np.testing.assert_allclose(fractional_occurrence(data), [0.5, 0.25, 0.25])
+
+
+def test_equivalent_smiles_are_cached():
+    """Test that equivalent SMILES share one cached result"""
+    _COMPLEXITY_CACHE.clear()
+    first = molecular_complexity("CCO")
+    second = molecular_complexity("OCC")
+    assert second is first
+    assert list(_COMPLEXITY_CACHE) == ["CCO"]
+
+
+def test_batch_complexity_calculation():
+    """Test that we can calculate molecular complexity of a list of SMILES"""
+    smiles = [test_case["smiles"] for test_case in TEST_CASES]
+    results = molecular_complexity_batch(smiles + ["not a smiles"])
+    assert results.shape == (len(TEST_CASES) + 1, 3)
+    expected = [
+        [test_case["cm"], test_case["cm_star"], test_case["cse"]]
+        for test_case in TEST_CASES
+    ]
+    np.testing.assert_allclose(results[:-1], expected, rtol=0, atol=1e-8)
+    assert np.isnan(results[-1]).all()
+
 
-class ComplexityTest(unittest.TestCase):
-    def test_complexity_calculation(self):
-        """Test that we can calculate molecular complexity"""
-        for test_case in TEST_CASES:
-            with self.subTest(smiles=test_case["smiles"]):
-                cm, cm_star, cse = molecular_complexity(test_case["smiles"])
-                self.assertAlmostEqual(cm, test_case["cm"])
-                self.assertAlmostEqual(cm_star, test_case["cm_star"])
-                self.assertAlmostEqual(cse, test_case["cse"])
+def test_numexpr_entropy_terms(monkeypatch):
+    """Test that numexpr gives the same metrics as plain NumPy"""
+    pytest.importorskip("numexpr")
+    smiles = [test_case["smiles"] for test_case in TEST_CASES + HYDROGEN_TEST_CASES]
+    expected = molecular_complexity_batch(smiles)
+    monkeypatch.setattr(complexity, "_NUMEXPR_MIN_SIZE", 0)
+    results = molecular_complexity_batch(smiles)
+    np.testing.assert_allclose(results, expected, rtol=0, atol=1e-12)
 
 
-if __name__ == "__main__":
-    res = unittest.main(verbosity=3, exit=False)
+def test_parallel_complexity_calculation():
+    """Test that we can calculate molecular complexity in worker processes"""
+    smiles = [test_case["smiles"] for test_case in TEST_CASES]
+    results = molecular_complexity_many(smiles, n_jobs=2, chunksize=10)
+    expected = [
+        [test_case["cm"], test_case["cm_star"], test_case["cse"]]
+        for test_case in TEST_CASES
+    ]
+    np.testing.assert_allclose(results, expected, rtol=0, atol=1e-8)